@@ -47,6 +47,19 @@ def store_gradients(name, self, grad_input, grad_output):
     gradients[(name, 'dZ')] = grad_output[0]
 
 
+def store_input(self, input):
+    """
+    Forward pre-hook function used to store the layer input (A_prev) as it is, i.e. without transposing it.
+    This function is used as a parameter for register_forward_pre_hook() in PyTorch.
+    For further information, see https://pytorch.org/docs/stable/nn.html#torch.nn.Module.register_forward_pre_hook
+
+    :param self: Self instance
+    :param input: Positional inputs of the layer
+    :return:
+    """
+    self.A_prev = input[0]
+
+
 class AutoOptimizer(Optimizer):
     """
     Base class for all auto optimizers. Provides basic functionality such as individual gradient computation,
@@ -71,8 +84,8 @@ class AutoOptimizer(Optimizer):
 
     def _prep_model(self, gamma0=0.999):
         """
-        Prepare the model for auto optimization. This includes registering the backward hook and initializing
-        variables.
+        Prepare the model for auto optimization. This includes registering the forward pre-hook and the backward
+        hook and initializing variables.
 
         :param gamma0: Initial value for gamma0.
         """
@@ -87,6 +100,7 @@ class AutoOptimizer(Optimizer):
                 else:
                     layer.input_layer = False
 
+                layer.register_forward_pre_hook(store_input)
                 layer.register_backward_hook(functools.partial(store_gradients, name))
                 for parameter in [layer.weight, layer.bias]:
                     parameter.layer_name = name
@@ -110,16 +124,15 @@ class AutoOptimizer(Optimizer):
         :return:
         """
         for name, layer in self.model._modules.items():
-            if isinstance(layer, torch.nn.Conv2d):
+            if isinstance(layer, (torch.nn.Conv2d, torch.nn.Linear)):
+                # dZ and A_prev are both kept in their native (N, ...) layout, no transposes are needed.
                 layer.dZ = gradients[(name, 'dZ')]
-            elif isinstance(layer, torch.nn.Linear):
-                layer.dZ = gradients[(name, 'dZ')].t()
             else:
                 continue
 
             if isinstance(layer, torch.nn.Linear):
-                layer.weight.grad_all = torch.bmm(layer.dZ.t().unsqueeze(2), layer.A_prev.t().unsqueeze(1)) * N
-                layer.bias.grad_all = gradients[(name, 'dZ')] * N
+                layer.weight.grad_all = torch.bmm(layer.dZ.unsqueeze(2), layer.A_prev.unsqueeze(1)) * N
+                layer.bias.grad_all = layer.dZ * N
             elif isinstance(layer, torch.nn.Conv2d):
                 layer.weight.grad_all = torch.zeros([N] + list(layer.weight.grad.shape))
                 for n in range(N):
@@ -0,0 +1,187 @@
+"""
+Copyright 2019 eBay Inc.
+Developers/Architects: Selcuk Kopru, Tomer Lancewicki
+
+Licensed under the Apache License, Version 2.0 (the "License");
+You may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.cpp_extension import load_inline
+
+
+CPP_SOURCE = 'torch::Tensor conv_relu_pool(torch::Tensor input, torch::Tensor weight, torch::Tensor bias);'
+
+CUDA_SOURCE = r'''
+#include <torch/extension.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <c10/cuda/CUDAException.h>
+
+#define TILE_X 16
+#define TILE_Y 8
+
+// Each block computes a TILE_X x TILE_Y tile of the pooled output of one (sample, output channel) pair. The
+// weights of the output channel are staged in shared memory. Each thread computes the four convolution outputs
+// of its 2x2 pooling window and keeps the maximum in a register, so the input is read once and only the pooled
+// output is written. max(relu(x)) == relu(max(x)), hence the running maximum starts at zero.
+template <int K>
+__global__ void conv_relu_pool_kernel(const float* __restrict__ input, const float* __restrict__ weight,
+                                      const float* __restrict__ bias, float* __restrict__ output,
+                                      int C_in, int H, int W, int C_out, int H_pool, int W_pool) {
+    extern __shared__ float weight_shared[];
+    const int n = blockIdx.z / C_out;
+    const int c_out = blockIdx.z % C_out;
+    const int weight_size = C_in * K * K;
+    for (int i = threadIdx.y * blockDim.x + threadIdx.x; i < weight_size; i += blockDim.x * blockDim.y) {
+        weight_shared[i] = weight[c_out * weight_size + i];
+    }
+    __syncthreads();
+
+    const int px = blockIdx.x * TILE_X + threadIdx.x;
+    const int py = blockIdx.y * TILE_Y + threadIdx.y;
+    if (px >= W_pool || py >= H_pool) {
+        return;
+    }
+
+    const float* input_n = input + (size_t)n * C_in * H * W;
+    float best = 0.0f;
+    for (int dy = 0; dy < 2; ++dy) {
+        for (int dx = 0; dx < 2; ++dx) {
+            const int oy = 2 * py + dy;
+            const int ox = 2 * px + dx;
+            float acc = bias[c_out];
+            for (int c = 0; c < C_in; ++c) {
+                const float* input_c = input_n + (size_t)c * H * W + oy * W + ox;
+                const float* weight_c = weight_shared + c * K * K;
+                #pragma unroll
+                for (int ky = 0; ky < K; ++ky) {
+                    #pragma unroll
+                    for (int kx = 0; kx < K; ++kx) {
+                        acc += input_c[ky * W + kx] * weight_c[ky * K + kx];
+                    }
+                }
+            }
+            best = fmaxf(best, acc);
+        }
+    }
+    output[(((size_t)n * C_out + c_out) * H_pool + py) * W_pool + px] = best;
+}
+
+torch::Tensor conv_relu_pool(torch::Tensor input, torch::Tensor weight, torch::Tensor bias) {
+    TORCH_CHECK(input.is_cuda() && weight.is_cuda() && bias.is_cuda(), "conv_relu_pool: expected CUDA tensors");
+    TORCH_CHECK(input.device() == weight.device() && input.device() == bias.device(),
+                "conv_relu_pool: expected all tensors on the same device");
+    TORCH_CHECK(input.scalar_type() == torch::kFloat32 && weight.scalar_type() == torch::kFloat32 &&
+                bias.scalar_type() == torch::kFloat32, "conv_relu_pool: expected float32 tensors");
+    TORCH_CHECK(input.dim() == 4 && weight.dim() == 4, "conv_relu_pool: expected 4-D input and weight");
+    TORCH_CHECK(input.size(1) == weight.size(1), "conv_relu_pool: input has ", input.size(1),
+                " channels, but the weight expects ", weight.size(1));
+    TORCH_CHECK(bias.numel() == weight.size(0), "conv_relu_pool: bias size does not match the output channels");
+    input = input.contiguous();
+    weight = weight.contiguous();
+    bias = bias.contiguous();
+
+    const int N = input.size(0), C_in = input.size(1), H = input.size(2), W = input.size(3);
+    const int C_out = weight.size(0), K = weight.size(2);
+    TORCH_CHECK(H >= K && W >= K, "conv_relu_pool: input is smaller than the kernel");
+    const int H_pool = (H - K + 1) / 2, W_pool = (W - K + 1) / 2;
+    TORCH_CHECK((long)N * C_out <= 65535, "conv_relu_pool: batch size times output channels is too large");
+
+    auto output = torch::empty({N, C_out, H_pool, W_pool}, input.options());
+    if (output.numel() == 0) {
+        // A zero-size grid cannot be launched.
+        return output;
+    }
+    const dim3 block(TILE_X, TILE_Y);
+    const dim3 grid((W_pool + TILE_X - 1) / TILE_X, (H_pool + TILE_Y - 1) / TILE_Y, N * C_out);
+    const size_t shared_size = C_in * K * K * sizeof(float);
+    const cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+    switch (K) {
+        case 3:
+            conv_relu_pool_kernel<3><<<grid, block, shared_size, stream>>>(
+                input.data_ptr<float>(), weight.data_ptr<float>(), bias.data_ptr<float>(),
+                output.data_ptr<float>(), C_in, H, W, C_out, H_pool, W_pool);
+            break;
+        case 5:
+            conv_relu_pool_kernel<5><<<grid, block, shared_size, stream>>>(
+                input.data_ptr<float>(), weight.data_ptr<float>(), bias.data_ptr<float>(),
+                output.data_ptr<float>(), C_in, H, W, C_out, H_pool, W_pool);
+            break;
+        default:
+            TORCH_CHECK(false, "conv_relu_pool: unsupported kernel size ", K);
+    }
+    C10_CUDA_KERNEL_LAUNCH_CHECK();
+    return output;
+}
+'''
+
+_extension = None
+
+
+def _load_extension():
+    """
+    Compile the CUDA extension on first use and cache it for the rest of the process.
+    """
+    global _extension
+    if _extension is None:
+        _extension = load_inline(name='autoopt_conv_relu_pool', cpp_sources=CPP_SOURCE, cuda_sources=CUDA_SOURCE,
+                                 functions=['conv_relu_pool'])
+    return _extension
+
+
+def conv_relu_pool(input, weight, bias):
+    """
+    Reference implementation of the fused kernel: 2D convolution, 2x2 max pooling and ReLU.
+    """
+    return F.relu(F.max_pool2d(F.conv2d(input, weight, bias), 2))
+
+
+class ConvReluPoolFunction(torch.autograd.Function):
+    """
+    Runs the fused CUDA kernel in the forward pass. The backward pass recomputes the forward pass with the
+    reference implementation and differentiates it with autograd.
+    """
+
+    @staticmethod
+    def forward(ctx, input, weight, bias):
+        ctx.save_for_backward(input, weight, bias)
+        return _load_extension().conv_relu_pool(input, weight, bias)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        inputs = [tensor.detach().requires_grad_(needs_grad)
+                  for tensor, needs_grad in zip(ctx.saved_tensors, ctx.needs_input_grad)]
+        with torch.enable_grad():
+            output = conv_relu_pool(*inputs)
+        grads = iter(torch.autograd.grad(output, [tensor for tensor in inputs if tensor.requires_grad], grad_output))
+        return tuple(next(grads) if tensor.requires_grad else None for tensor in inputs)
+
+
+class FusedConvReluPool(nn.Conv2d):
+    """
+    Conv2d followed by 2x2 max pooling and ReLU. On CUDA, float32 inputs with a 3x3 or 5x5 kernel and the default
+    stride, padding, dilation and groups are computed by a single fused kernel. Otherwise the regular PyTorch
+    operations are used.
+    """
+
+    def forward(self, input):
+        if self._fusable(input):
+            return ConvReluPoolFunction.apply(input, self.weight, self.bias)
+        return F.relu(F.max_pool2d(super(FusedConvReluPool, self).forward(input), 2))
+
+    def _fusable(self, input):
+        return input.is_cuda and input.dim() == 4 and input.shape[1] == self.in_channels and \
+            input.dtype == torch.float32 and self.weight.dtype == torch.float32 and self.bias is not None and \
+            self.kernel_size in [(3, 3), (5, 5)] and self.stride == (1, 1) and self.padding == (0, 0) and \
+            self.dilation == (1, 1) and self.groups == 1 and \
+            input.shape[0] * self.out_channels <= 65535 and not torch.is_autocast_enabled()
@@ -14,59 +14,153 @@ limitations under the License.
 """
 
 import argparse
+import sys
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchvision import datasets, transforms
-from torch.autograd import Variable
+from torchvision import datasets
 from autoopt import AutoOptError
 from autoopt.optim import GaussNewton, AutoSGD, AutoAdam, AutoGaussNewton
-
-
-class FCNet(nn.Module):
-    def __init__(self):
-        nn.Module.__init__(self)
-        self.fc_0 = nn.Linear(784, 320)
-        self.fc_1 = nn.Linear(320, 50)
-        self.fc_2 = nn.Linear(50, 10)
-
-    def forward(self, x):
-        x = x.view(-1, 784)
-        self.fc_0.A_prev = x.t()
-        x = F.relu(self.fc_0(x))
-        self.fc_1.A_prev = x.t()
-        x = F.relu(self.fc_1(x))
-        self.fc_2.A_prev = x.t()
-        if use_mse_loss:
-            return F.softmax(self.fc_2(x), dim=1)
-        else:
-            return F.log_softmax(self.fc_2(x), dim=1)
+from fused_conv import FusedConvReluPool
+
+
+class FCNet(nn.Sequential):
+    def __init__(self, mse=False):
+        # The layers are kept as named top level modules, the auto optimizers register their hooks on them.
+        layers = [
+            ('flatten', nn.Flatten()),
+            ('fc_0', nn.Linear(784, 320)),
+            ('relu_0', nn.ReLU()),
+            ('fc_1', nn.Linear(320, 50)),
+            ('relu_1', nn.ReLU()),
+            ('fc_2', nn.Linear(50, 10))
+        ]
+        if mse:
+            layers.append(('softmax', nn.Softmax(dim=1)))
+        nn.Sequential.__init__(self, OrderedDict(layers))
+        # True if the model returns softmax probabilities instead of logits.
+        self.mse = mse
 
 
 class CNN(nn.Module):
-    def __init__(self):
+    def __init__(self, fused_conv=False):
         nn.Module.__init__(self)
-        self.conv1 = nn.Conv2d(1, 10, kernel_size=5)
-        self.conv2 = nn.Conv2d(10, 20, kernel_size=5)
+        self.fused_conv = fused_conv
+        conv = FusedConvReluPool if fused_conv else nn.Conv2d
+        self.conv1 = conv(1, 10, kernel_size=5)
+        self.conv2 = conv(10, 20, kernel_size=5)
         self.conv2_drop = nn.Dropout2d()
         self.fc1 = nn.Linear(320, 50)
+        self.fc1_drop = nn.Dropout()
         self.fc2 = nn.Linear(50, 10)
+        # The CNN always returns logits.
+        self.mse = False
 
     def forward(self, x):
-        self.conv1.A_prev = x
-        x = self.conv1(x)
-        x = F.relu(F.max_pool2d(x, 2))
-        self.conv2.A_prev = x
-        x = self.conv2(x)
-        self.conv2_drop.A_prev = x
-        x = F.relu(F.max_pool2d(self.conv2_drop(x), 2))
-        x = x.view(-1, 320)
-        self.fc1.A_prev = x.t()
-        x = F.relu(self.fc1(x))
-        x = F.dropout(x, training=self.training)
-        self.fc2.A_prev = x.t()
-        x = self.fc2(x)
-        return F.log_softmax(x, dim=1)
+        if self.fused_conv:
+            x = self.conv1(x)
+            # Dropping whole channels commutes with max pooling and ReLU, so it is applied after the fused layer.
+            x = self.conv2_drop(self.conv2(x))
+        else:
+            x = self.conv1(x)
+            x = F.relu(F.max_pool2d(x, 2), inplace=True)
+            x = self.conv2(x)
+            x = F.relu(F.max_pool2d(self.conv2_drop(x), 2), inplace=True)
+        x = x.reshape(-1, 320)
+        x = F.relu(self.fc1(x), inplace=True)
+        x = self.fc1_drop(x)
+        return self.fc2(x)
+
+
+class CUDAPrefetcher:
+    """
+    Iterates over a data loader and copies the next batch to the GPU on a side stream while the current batch is
+    being processed.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        next_batch = self._preload(batches)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            data, target = next_batch
+            # The batch was allocated on the side stream, let the allocator know it is used on the main stream.
+            data.record_stream(torch.cuda.current_stream())
+            target.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(batches)
+            yield data, target
+
+    def _preload(self, batches):
+        try:
+            data, target = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return data.cuda(non_blocking=True), target.cuda(non_blocking=True)
+
+
+class CUDAGraphStep:
+    """
+    Runs forward pass, backward pass and optimizer step of a training iteration as a single CUDA graph replay.
+    The first warmup_iters batches are trained eagerly on a side stream, so that cuDNN autotuning and the allocator
+    settle. The graph is captured on the next batch. From then on, every call copies the batch into the static
+    input buffers of the graph and replays it, so all batches must have the same shape. Every batch is trained
+    exactly once, as in an eager run.
+    """
+
+    def __init__(self, model, optimizer, warmup_iters=11):
+        self.model = model
+        self.mse = model.mse
+        self.optimizer = optimizer
+        self.warmup_iters = warmup_iters
+        self.iters = 0
+        self.stream = torch.cuda.Stream()
+        self.graph = None
+
+    def __call__(self, data, target):
+        if self.graph is None:
+            if self.iters < self.warmup_iters:
+                self.iters += 1
+                return self._warmup_step(data, target)
+            self._capture(data, target)
+        self.static_data.copy_(data, non_blocking=True)
+        self.static_target.copy_(target, non_blocking=True)
+        self.graph.replay()
+        return self.static_loss
+
+    def _step(self, data, target):
+        loss = criterion(self.model(data), target, self.mse)
+        loss.backward()
+        self.optimizer.step()
+        return loss
+
+    def _warmup_step(self, data, target):
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            self.optimizer.zero_grad(set_to_none=True)
+            loss = self._step(data, target)
+        torch.cuda.current_stream().wait_stream(self.stream)
+        return loss
+
+    def _capture(self, data, target):
+        self.static_data = data.clone()
+        self.static_target = target.clone()
+
+        # Gradients are allocated from the graph's memory pool during the capture and overwritten by every replay,
+        # so they must not be reset between replays. The capture only records the step, the batch is trained by the
+        # first replay.
+        self.optimizer.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_loss = self._step(self.static_data, self.static_target)
 
 
 def get_args():
@@ -96,14 +190,36 @@ def get_args():
                         help='[0.999] Beta 2, Exponential decay rate for the moment estimates.')
     parser.add_argument('--eps', type=float, default=1e-3, metavar='E',
                         help='[1e-3] Epsilon, regularization coefficient.')
+    parser.add_argument('--workers', type=int, default=2, metavar='W',
+                        help='[2] Number of data loader worker processes (0 loads in the main process).')
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='[False] Disables CUDA training.')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='[False] Compile the model forward pass with torch.compile (PyTorch 2.0+).')
+    parser.add_argument('--compile-mode', choices=['default', 'reduce-overhead', 'max-autotune'],
+                        default='reduce-overhead', help='[reduce-overhead] torch.compile mode.')
+    parser.add_argument('--jit', action='store_true', default=False,
+                        help='[False] Script the model with TorchScript. Only for sgd and adam.')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='[False] Enables mixed precision training on CUDA, BF16 on Ampere and newer GPUs, '
+                             'FP16 otherwise. Only for sgd and adam.')
+    parser.add_argument('--cuda-graph', action='store_true', default=False,
+                        help='[False] Capture the training step in a CUDA graph. Only for sgd and adam.')
+    parser.add_argument('--fused-conv', action='store_true', default=False,
+                        help='[False] Use a fused Conv2d+MaxPool+ReLU CUDA kernel in the cnn model. '
+                             'Only for sgd and adam.')
     parser.add_argument('--seed', type=int, default=-1, metavar='S',
                         help='[-1] Random seed (-1 means no seed).')
     parser.add_argument('--log-interval', type=int, default=100, metavar='I',
                         help='[100] How many batches to wait before logging training status.')
     args = parser.parse_args()
     args.cuda = not args.no_cuda and torch.cuda.is_available()
+    args.amp = args.amp and args.cuda
+    # BF16 has the exponent range of FP32 and does not need loss scaling, use it where Tensor Cores support it.
+    args.amp_dtype = torch.bfloat16 if args.amp and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    args.cuda_graph = args.cuda_graph and args.cuda
+    # The fused conv kernel indexes NCHW tensors, channels_last would only add layout copies around it.
+    args.channels_last = args.cuda and args.model == 'cnn' and not args.fused_conv
 
     if args.seed != -1:
         torch.manual_seed(args.seed)
@@ -114,93 +230,161 @@ def get_args():
     return args
 
 
+def get_dataset(train):
+    """
+    Load MNIST once and keep it in memory as a uint8 tensor dataset. Batches are normalized with normalize() after
+    they are moved to the device, so only one byte per pixel is copied.
+
+    :param train: True for the training set, False for the test set.
+    :return: TensorDataset of (N, 1, 28, 28) uint8 images and (N,) targets.
+    """
+    mnist = datasets.MNIST('./data', train=train, download=True)
+    return torch.utils.data.TensorDataset(mnist.data.unsqueeze(1), mnist.targets)
+
+
+def normalize(data):
+    """
+    Convert a uint8 image batch to FP32 and normalize it. This is equivalent to applying ToTensor() and
+    Normalize((0.1307,), (0.3081,)) to every sample.
+
+    :param data: uint8 image batch.
+    :return: Normalized FP32 image batch.
+    """
+    return data.float().div_(255.).sub_(0.1307).div_(0.3081)
+
+
 def get_data(args):
-    kwargs = {'num_workers': 1, 'pin_memory': True} if args.cuda else {}
+    kwargs = {'num_workers': args.workers, 'pin_memory': args.cuda, 'persistent_workers': args.workers > 0}
+    train_set = get_dataset(train=True)
+    test_set = get_dataset(train=False)
+    if args.workers > 0:
+        # Workers index into shared memory instead of receiving a pickled copy of the dataset.
+        for tensor in train_set.tensors + test_set.tensors:
+            tensor.share_memory_()
+    # A captured CUDA graph only accepts batches of the captured shape, so the last partial batch is dropped.
     train_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=True, download=True,
-                       transform=transforms.Compose([
-                           transforms.ToTensor(),
-                           transforms.Normalize((0.1307,), (0.3081,))
-                       ])),
-        batch_size=args.batch_size, shuffle=True, **kwargs)
+        train_set, batch_size=args.batch_size, shuffle=True, drop_last=args.cuda_graph, **kwargs)
     test_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=False, transform=transforms.Compose([
-                           transforms.ToTensor(),
-                           transforms.Normalize((0.1307,), (0.3081,))
-                       ])),
-        batch_size=args.test_batch_size, shuffle=True, **kwargs)
+        test_set, batch_size=args.test_batch_size, shuffle=True, **kwargs)
     return train_loader, test_loader
 
 
 use_mse_loss = False
 
 
-def train(epoch, model, args, train_loader, optimizer):
+def criterion(output, target, mse=False, reduction='mean'):
+    """
+    Classification loss of the model output. Softmax probabilities must not be normalized a second time, so
+    F.nll_loss is used for them and F.cross_entropy for logits.
+
+    :param output: Model output.
+    :param target: Target classes.
+    :param mse: True if the output holds softmax probabilities (model.mse), False if it holds logits.
+    :param reduction: Loss reduction, see F.cross_entropy().
+    :return: Loss.
+    """
+    if mse:
+        return F.nll_loss(output, target, reduction=reduction)
+    return F.cross_entropy(output, target, reduction=reduction)
+
+
+def train(epoch, model, args, train_loader, optimizer, scaler, graph_step=None):
     model.train()
-    for batch_idx, (data, target) in enumerate(train_loader):
-        if args.cuda:
-            data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
-        optimizer.zero_grad()
-        output = model(data)
-
-        if args.optimizer in ['sgd', 'adam', 'adagrad']:
-            loss = F.nll_loss(output, target)
+    batches = CUDAPrefetcher(train_loader) if args.cuda else train_loader
+    # NaN losses are flagged on the device and only checked when the loss is logged, avoiding a sync per step.
+    nan_flag = torch.zeros((), dtype=torch.bool, device='cuda' if args.cuda else 'cpu')
+    # The built-in optimizers only need the mean loss, the auto optimizers also need the per-sample losses.
+    use_scalar_loss = args.optimizer in ['sgd', 'adam', 'adagrad']
+    mse = model.mse
+    for batch_idx, (data, target) in enumerate(batches):
+        data = normalize(data)
+        if args.channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
+        if graph_step is not None:
+            loss = graph_step(data, target)
         else:
-            model.loss_all = F.nll_loss(output, target, reduction='none')
-            loss = torch.mean(model.loss_all)
+            optimizer.zero_grad(set_to_none=True)
+            with torch.cuda.amp.autocast(enabled=args.amp, dtype=args.amp_dtype):
+                output = model(data)
 
-        if torch.isnan(loss):
-            import sys
-            sys.exit()
+                if use_scalar_loss:
+                    loss = criterion(output, target, mse)
+                else:
+                    model.loss_all = criterion(output, target, mse, reduction='none')
+                    loss = torch.mean(model.loss_all)
 
-        loss.backward()
-        optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+        nan_flag |= torch.isnan(loss.detach())
 
         if batch_idx % args.log_interval == 0:
+            if nan_flag.item():
+                sys.exit()
+            loss_val = loss.item()
             print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                 epoch, batch_idx * len(data), len(train_loader.dataset),
-                100. * batch_idx / len(train_loader), loss))
+                100. * batch_idx / len(train_loader), loss_val))
+
+    if nan_flag.item():
+        sys.exit()
 
 
 def test(model, args, test_loader):
     model.eval()
-    test_loss = 0
-    correct = 0
-    for data, target in test_loader:
-        if args.cuda:
-            data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
-        output = model(data)
-        test_loss += F.nll_loss(output, target) # sum up batch loss
-        pred = output.data.max(1, keepdim=True)[1] # get the index of the max log-probability
-        correct += pred.eq(target.data.view_as(pred)).cpu().sum()
-
-    test_loss /= len(test_loader.dataset)
+    mse = model.mse
+    device = 'cuda' if args.cuda else 'cpu'
+    # Accumulate on the device and synchronize once after the loop.
+    test_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    with torch.no_grad():
+        for data, target in test_loader:
+            if args.cuda:
+                data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
+            data = normalize(data)
+            if args.channels_last:
+                data = data.contiguous(memory_format=torch.channels_last)
+            output = model(data)
+            test_loss += criterion(output, target, mse, reduction='sum') # sum up batch loss
+            pred = output.max(1, keepdim=True)[1] # get the index of the max logit
+            correct += pred.eq(target.view_as(pred)).sum()
+
+    test_loss = test_loss.item() / len(test_loader.dataset)
+    correct = correct.item()
+    acc_pct = 100. * correct / len(test_loader.dataset)
     print('\nTest set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(
-        test_loss, correct, len(test_loader.dataset),
-        100. * correct / len(test_loader.dataset)))
+        test_loss, correct, len(test_loader.dataset), acc_pct))
 
 
 def main():
     args = get_args()
+    # Let cuDNN pick the fastest convolution algorithms for the fixed input sizes.
+    torch.backends.cudnn.benchmark = True
     train_loader, test_loader = get_data(args)
     if args.model == 'fc':
-        model = FCNet()
+        model = FCNet(mse=use_mse_loss)
     elif args.model == 'cnn':
-        model = CNN()
+        model = CNN(fused_conv=args.fused_conv)
     else:
         raise AutoOptError('Error: Unknown model type: {0}'.format(args.model))
 
     if args.cuda:
         model.cuda()
 
+    if args.channels_last:
+        # NHWC layout lets cuDNN use its Tensor Core convolution kernels.
+        model = model.to(memory_format=torch.channels_last)
+
     if args.optimizer == 'sgd':
         optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, dampening=args.momentum)
     elif args.optimizer == 'auto-sgd':
         optimizer = AutoSGD(model)
     elif args.optimizer == 'adam':
-        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, betas=(args.beta_1, args.beta_2), eps=args.eps)
+        # capturable is only passed when needed, it is not supported by older PyTorch releases.
+        kwargs = {'capturable': True} if args.cuda_graph else {}
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, betas=(args.beta_1, args.beta_2), eps=args.eps,
+                                     **kwargs)
     elif args.optimizer == 'auto-adam':
         optimizer = AutoAdam(model)
     elif args.optimizer == 'gauss-newton' or args.optimizer == 'gn':
@@ -210,8 +394,39 @@ def main():
     else:
         raise AutoOptError('Error: Unknown optimizer: {0}'.format(args.optimizer))
 
+    if args.amp and args.optimizer not in ['sgd', 'adam']:
+        raise AutoOptError('Error: Mixed precision is not supported by optimizer: {0}'.format(args.optimizer))
+    if args.fused_conv and args.optimizer not in ['sgd', 'adam']:
+        raise AutoOptError('Error: Fused convolutions are not supported by optimizer: {0}'.format(args.optimizer))
+    if args.jit and args.optimizer not in ['sgd', 'adam']:
+        raise AutoOptError('Error: TorchScript is not supported by optimizer: {0}'.format(args.optimizer))
+    if args.jit and (args.compile or args.fused_conv):
+        raise AutoOptError('Error: --jit cannot be combined with --compile or --fused-conv.')
+    if args.cuda_graph and args.optimizer not in ['sgd', 'adam']:
+        raise AutoOptError('Error: CUDA graphs are not supported by optimizer: {0}'.format(args.optimizer))
+    if args.cuda_graph and (args.amp or args.compile or args.jit):
+        raise AutoOptError('Error: --cuda-graph cannot be combined with --amp, --compile or --jit.')
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and args.amp_dtype == torch.float16)
+    graph_step = CUDAGraphStep(model, optimizer) if args.cuda_graph else None
+
+    if args.jit:
+        # The scripted module shares its parameters with the original one, so the optimizer stays valid.
+        model = torch.jit.script(model)
+        # The profiling executor specializes the graph after a few runs, warm it up before training.
+        example = torch.zeros(args.batch_size, 1, 28, 28, device='cuda' if args.cuda else 'cpu')
+        if args.channels_last:
+            example = example.contiguous(memory_format=torch.channels_last)
+        for _ in range(3):
+            model(example)
+
+    if args.compile:
+        # Compile the bound forward in place so that the optimizers keep working on the original module and its
+        # layers. Graph breaks are allowed (fullgraph=False). The batch shape is fixed, so the graph is specialized to
+        # it (dynamic=False).
+        model.forward = torch.compile(model.forward, mode=args.compile_mode, fullgraph=False, dynamic=False)
+
     for epoch in range(1, args.epochs + 1):
-        train(epoch, model, args, train_loader, optimizer)
+        train(epoch, model, args, train_loader, optimizer, scaler, graph_step)
         test(model, args, test_loader)
 
 
@@ -0,0 +1,96 @@
+"""
+Copyright 2019 eBay Inc.
+Developers/Architects: Selcuk Kopru, Tomer Lancewicki
+
+Licensed under the Apache License, Version 2.0 (the "License");
+You may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import unittest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'examples'))
+from fused_conv import ConvReluPoolFunction, FusedConvReluPool, conv_relu_pool
+
+
+class TestFusedConvReluPool(unittest.TestCase):
+
+    def _compare(self, module, input):
+        """
+        Compare the output and the input, weight and bias gradients of the module against the reference ops.
+        """
+        weight = module.weight.detach().clone().requires_grad_()
+        bias = module.bias.detach().clone().requires_grad_()
+        input_ref = input.detach().clone().requires_grad_()
+        input = input.detach().clone().requires_grad_()
+
+        output = module(input)
+        output_ref = conv_relu_pool(input_ref, weight, bias) if input.dim() == 4 else \
+            conv_relu_pool(input_ref.unsqueeze(0), weight, bias).squeeze(0)
+        self.assertEqual(output.shape, output_ref.shape)
+        self.assertTrue(torch.allclose(output, output_ref, atol=1e-4, rtol=1e-4))
+
+        grad_output = torch.rand_like(output)
+        output.backward(grad_output)
+        output_ref.backward(grad_output)
+        self.assertTrue(torch.allclose(input.grad, input_ref.grad, atol=1e-4, rtol=1e-4))
+        self.assertTrue(torch.allclose(module.weight.grad, weight.grad, atol=1e-3, rtol=1e-4))
+        self.assertTrue(torch.allclose(module.bias.grad, bias.grad, atol=1e-3, rtol=1e-4))
+
+    def test_fallback(self):
+        module = FusedConvReluPool(3, 8, kernel_size=5)
+        self._compare(module, torch.randn(4, 3, 29, 27))
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'CUDA is not available')
+    def test_fused(self):
+        allow_tf32 = torch.backends.cudnn.allow_tf32
+        # The reference convolution must run in full FP32 precision to be comparable with the fused kernel.
+        torch.backends.cudnn.allow_tf32 = False
+        try:
+            for kernel_size in [3, 5]:
+                for batch_size in [64, 1000]:
+                    with self.subTest(kernel_size=kernel_size, batch_size=batch_size):
+                        module = FusedConvReluPool(3, 8, kernel_size=kernel_size).cuda()
+                        input = torch.randn(batch_size, 3, 29, 27, device='cuda')
+                        self.assertTrue(module._fusable(input))
+                        self._compare(module, input)
+        finally:
+            torch.backends.cudnn.allow_tf32 = allow_tf32
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'CUDA is not available')
+    def test_unbatched_input(self):
+        module = FusedConvReluPool(3, 8, kernel_size=5).cuda()
+        input = torch.randn(3, 29, 27, device='cuda')
+        self.assertFalse(module._fusable(input))
+        self._compare(module, input)
+
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'CUDA is not available')
+    def test_empty_batch(self):
+        module = FusedConvReluPool(3, 8, kernel_size=5).cuda()
+        input = torch.randn(0, 3, 29, 27, device='cuda')
+        self.assertTrue(module._fusable(input))
+        self.assertEqual(module(input).shape, (0, 8, 12, 11))
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'CUDA is not available')
+    def test_wrong_channels(self):
+        module = FusedConvReluPool(3, 8, kernel_size=5).cuda()
+        input = torch.randn(4, 2, 29, 27, device='cuda')
+        self.assertFalse(module._fusable(input))
+        with self.assertRaises(RuntimeError):
+            module(input)
+        with self.assertRaises(RuntimeError):
+            ConvReluPoolFunction.apply(input, module.weight, module.bias)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,8 @@ limitations under the License.
 
 import unittest
 import functools
-from autoopt.optim.auto_optimizer import AutoOptimizer, store_gradients
+import torch
+from autoopt.optim.auto_optimizer import AutoOptimizer, store_gradients, store_input
 from tests.model import TestModel
 
 
@@ -32,6 +33,27 @@ class TestAutoOptimizer(unittest.TestCase):
             if hasattr(layer, 'weight'):
                 layer.register_backward_hook(functools.partial(store_gradients, name))
 
+    def test_store_input(self):
+        model = TestModel()
+        model.fc.register_forward_pre_hook(store_input)
+        input = torch.rand(8, 10)
+        model(input)
+        self.assertIs(model.fc.A_prev, input)
+
+    def test_compute_individual_gradients(self):
+        model = TestModel()
+        auto_optimizer = AutoOptimizer(model=model, defaults={})
+        N = 8
+        # The softmax over the single output of TestModel is constant, use the hooked layer directly so that the
+        # individual gradients are not all zero.
+        model.loss_all = (model.fc(torch.rand(N, 10)).squeeze(1) - torch.rand(N)) ** 2
+        torch.mean(model.loss_all).backward()
+        auto_optimizer.step()
+        self.assertEqual(model.fc.weight.grad_all.shape, (N, 1, 10))
+        self.assertEqual(model.fc.bias.grad_all.shape, (N, 1))
+        self.assertTrue(torch.allclose(model.fc.weight.grad_all.mean(0), model.fc.weight.grad))
+        self.assertTrue(torch.allclose(model.fc.bias.grad_all.mean(0), model.fc.bias.grad))
+
 
 if __name__ == '__main__':
     unittest.main()